@@ -1,58 +1,342 @@
-import argparse
-import serial
+import math
+import os
+import signal
+import socket
+import sys
 import time
+import types
 
-BEGIN = b'\xfa'
+BEGIN = 0xfa
 MODE = {
-    'off': b'\x04',
-    'auto': b'\x05',
-    'rainbow': b'\x01',
-    'breathing': b'\x02',
-    'cycle': b'\x03',
-}
-BRIGHTNESS = {
-    '1': b'\x05',
-    '2': b'\x04',
-    '3': b'\x03',
-    '4': b'\x02',
-    '5': b'\x01',
-}
-SPEED = {
-    '1': b'\x05',
-    '2': b'\x04',
-    '3': b'\x03',
-    '4': b'\x02',
-    '5': b'\x01',
+    'off': 0x04,
+    'auto': 0x05,
+    'rainbow': 0x01,
+    'breathing': 0x02,
+    'cycle': 0x03,
 }
+# Brightness and speed values for levels '1'..'5', in order
+LEVELS = ('1', '2', '3', '4', '5')
+BRIGHTNESS = b'\x05\x04\x03\x02\x01'
+SPEED = b'\x05\x04\x03\x02\x01'
+
+# Every valid command is known in advance, so build them all once.
+# The last byte is the checksum: the sum of the other four, truncated to 8 bits.
+PACKETS = {(m, b, s): bytes([BEGIN, mv, bv, sv, (BEGIN + mv + bv + sv) & 0xff])
+           for m, mv in MODE.items()
+           for b, bv in zip(LEVELS, BRIGHTNESS)
+           for s, sv in zip(LEVELS, SPEED)}
+VALID_PACKETS = frozenset(PACKETS.values())
+# Hex dump of each packet for verbose output
+PACKET_HEX = {p: p.hex(' ') for p in PACKETS.values()}
+
+def build_packet(mode, brightness, speed):
+    return PACKETS[(mode, brightness, speed)]
 
-def checksum(mode, brightness, speed):
-    int_checksum = (int.from_bytes(BEGIN)
-                    + int.from_bytes(MODE[mode])
-                    + int.from_bytes(BRIGHTNESS[brightness])
-                    + int.from_bytes(SPEED[speed])) & 0xff
-    return int_checksum.to_bytes()
+# Last packet sent, followed by the serial port it was sent to
+STATE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 't9plus_led_state')
 
-def control(serial_port, mode, brightness, speed):
+def read_state():
+    try:
+        with open(STATE_FILE, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def write_state(state):
+    tmp = f'{STATE_FILE}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(state)
+        os.replace(tmp, STATE_FILE)
+    except OSError:
+        # The cache is only an optimization, just don't leave the temp file behind
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+def import_serial():
+    # pyserial is slow to import, so only load it once a port is needed
+    try:
+        import serial
+    except ImportError:
+        print('pyserial is required: pip install pyserial', file=sys.stderr)
+        sys.exit(1)
+    return serial
+
+def open_port(serial_port):
+    serial = import_serial()
     s = serial.Serial(serial_port, 10000)  # The baud rate is fixed at 10000
-    for i in [BEGIN,
-              MODE[mode],
-              BRIGHTNESS[brightness],
-              SPEED[speed],
-              checksum(mode, brightness, speed)]:
-        s.write(i)
-        time.sleep(0.005)
+    if sys.platform.startswith('linux'):
+        # USB serial adapters buffer writes for up to 16 ms by default
+        try:
+            s.set_low_latency_mode(True)
+        except ValueError:
+            pass  # Not supported by this driver
+        # pyserial opens the port with O_NONBLOCK. write() calls os.write()
+        # on the fd directly, so make it block until the kernel takes the data
+        # instead of failing with BlockingIOError when the buffer is full.
+        os.set_blocking(s.fileno(), True)
+    return s
+
+def write(s, data):
+    # Write and wait until the data has left the UART
+    if sys.platform.startswith('linux'):
+        # Skip pyserial's write() wrapper and use the file descriptor directly
+        import termios
+        fd = s.fileno()
+        while data:  # os.write() may still write only part of the data
+            data = data[os.write(fd, data):]
+        try:
+            termios.tcdrain(fd)
+        except termios.error as e:
+            # termios.error is not an OSError, unlike everything else here
+            raise OSError(*e.args) from e
+    else:
+        s.write(data)
+        s.flush()
+
+def send(s, packet, delay=0):
+    if delay:
+        # Some adapters need a gap between bytes. write() waits until each
+        # byte has actually left the UART, so the gap is measured from there.
+        for i in range(len(packet)):
+            write(s, packet[i:i + 1])
+            if i < len(packet) - 1:
+                time.sleep(delay)
+    else:
+        write(s, packet)
+
+def control(serial_port, packet, delay=0):
+    s = open_port(serial_port)
+    send(s, packet, delay)
     s.close()
 
-def main():
+# A daemon keeps the serial port open so that each command does not pay
+# for opening it. Requests are a packet followed by the inter-byte delay
+# and the serial port name, separated by a NUL byte, and are answered with
+# a single ACK or NAK byte. The daemon only serves requests whose port and
+# delay match its own.
+ACK = b'\x01'
+NAK = b'\x00'
+# How long the daemon waits for a connected client to send its request
+REQUEST_TIMEOUT = 0.5
+# How long a client waits for the answer, on top of the inter-byte gaps.
+# Well above REQUEST_TIMEOUT, since the client may be queued behind others.
+REPLY_TIMEOUT = 10
+
+def socket_path():
+    run_dir = os.environ.get('XDG_RUNTIME_DIR') or f'/run/user/{os.getuid()}'
+    return os.path.join(run_dir, 't9plus.sock')
+
+def daemon_running(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except OSError:
+            return False
+    return True
+
+def reply(conn, answer):
+    try:
+        conn.sendall(answer)
+    except OSError:
+        pass  # The client has gone away, that must not stop the daemon
+
+def daemon(serial_port, delay=0):
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.exit('--daemon needs Unix domain sockets, which are not available on this platform')
+    path = socket_path()
+    # Check before opening the port, which toggles DTR on many adapters
+    if daemon_running(path):
+        sys.exit(f'A daemon is already listening on {path}')
+    s = open_port(serial_port)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            os.unlink(path)  # Left over from a daemon that did not exit cleanly
+        except FileNotFoundError:
+            pass
+        server.bind(path)
+        server.listen()
+    except OSError as e:
+        # Reported here, main() would blame the serial port
+        server.close()
+        s.close()
+        sys.exit(f'Socket {path}: {e}')
+    print(f'Listening on {path}')
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                # Don't let a client that never sends anything block the others
+                conn.settimeout(REQUEST_TIMEOUT)
+                try:
+                    request = conn.recv(1024)
+                except OSError:
+                    continue
+                if not request:
+                    continue  # Only checking whether a daemon is running
+                packet = request[:5]
+                requested_delay, _, port = request[5:].decode(errors='replace').partition('\0')
+                if (port != serial_port
+                        or requested_delay != repr(float(delay))
+                        or packet not in VALID_PACKETS):
+                    reply(conn, NAK)
+                    continue
+                try:
+                    send(s, packet, delay)
+                except OSError:  # Includes serial.SerialException
+                    reply(conn, NAK)
+                    raise
+                reply(conn, ACK)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
+        s.close()
+
+def control_via_daemon(serial_port, packet, delay=0):
+    # Returns False if there is no daemon or it declines the request, in
+    # which case the caller opens the port itself
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(REPLY_TIMEOUT + delay * (len(packet) - 1))
+        try:
+            client.connect(socket_path())
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False  # No daemon running
+        # From here on the daemon may be sending the packet, so any failure
+        # is an error: falling back could put a second packet on the wire
+        client.sendall(packet + f'{float(delay)!r}\0{serial_port}'.encode())
+        answer = client.recv(1)
+    if answer == NAK:
+        return False
+    if answer != ACK:
+        raise ConnectionError('the daemon closed the connection without answering')
+    return True
+
+DEFAULTS = {
+    'mode': None,
+    'brightness': '3',
+    'speed': '3',
+    'serial_port': 'COM3',
+    'inter_byte_delay': 0,
+    'verbose': False,
+    'force': False,
+    'daemon': False,
+}
+# Command line options for parse_args_fast(), mapped to their destinations
+OPTIONS = {
+    '--brightness': 'brightness',
+    '--speed': 'speed',
+    '--serial-port': 'serial_port',
+    '--inter-byte-delay': 'inter_byte_delay',
+}
+FLAGS = {
+    '--slow': ('inter_byte_delay', 0.005),
+    '-v': ('verbose', True),
+    '--verbose': ('verbose', True),
+    '--force': ('force', True),
+    '--daemon': ('daemon', True),
+}
+
+def valid_delay(delay):
+    return math.isfinite(delay) and delay >= 0
+
+def parse_args_fast(argv):
+    # Handles the common, well-formed command lines without importing
+    # argparse. Returns None for anything else (--help, errors, abbreviated
+    # options, --opt=value) so parse_args() can deal with it.
+    args = dict(DEFAULTS)
+    argv = iter(argv)
+    for arg in argv:
+        if arg in FLAGS:
+            name, value = FLAGS[arg]
+            args[name] = value
+        elif arg in OPTIONS:
+            value = next(argv, None)
+            if value is None or value.startswith('-'):
+                return None
+            args[OPTIONS[arg]] = value
+        elif arg in MODE and args['mode'] is None:
+            args['mode'] = arg
+        else:
+            return None
+    if args['brightness'] not in LEVELS or args['speed'] not in LEVELS:
+        return None
+    if args['mode'] is None and not args['daemon']:
+        return None
+    try:
+        args['inter_byte_delay'] = float(args['inter_byte_delay'])
+    except ValueError:
+        return None
+    if not valid_delay(args['inter_byte_delay']):
+        return None
+    return types.SimpleNamespace(**args)
+
+def parse_args(argv):
+    import argparse
+
+    def delay(value):
+        try:
+            seconds = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid float value: {value!r}')
+        if not valid_delay(seconds):
+            raise argparse.ArgumentTypeError(f'must be a finite number of seconds, 0 or more: {value!r}')
+        return seconds
+
     parser = argparse.ArgumentParser(description='Control LED lights')
-    parser.add_argument('mode', choices=MODE.keys(), help='LED mode')
-    parser.add_argument('--brightness', choices=BRIGHTNESS.keys(), default='3', help='LED brightness (default: 3)')
-    parser.add_argument('--speed', choices=SPEED.keys(), default='3', help='LED speed (default: 3)')
-    parser.add_argument('--serial-port', default='COM3', help='Serial port (default: COM3)')
-    args = parser.parse_args()
+    parser.add_argument('mode', nargs='?', choices=MODE.keys(), help='LED mode')
+    parser.add_argument('--brightness', choices=LEVELS, help='LED brightness (default: 3)')
+    parser.add_argument('--speed', choices=LEVELS, help='LED speed (default: 3)')
+    parser.add_argument('--serial-port', help='Serial port (default: COM3)')
+    parser.add_argument('--inter-byte-delay', type=delay, metavar='SECONDS',
+                        help='Send one byte at a time with this gap between bytes (default: 0, send at once)')
+    parser.add_argument('--slow', dest='inter_byte_delay', action='store_const', const=0.005,
+                        help='Same as --inter-byte-delay 0.005')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the bytes sent')
+    parser.add_argument('--force', action='store_true', help='Send even if the setting has not changed')
+    parser.add_argument('--daemon', action='store_true', help='Keep the serial port open and serve other invocations')
+    parser.set_defaults(**DEFAULTS)
+    args = parser.parse_args(argv)
+    if args.mode is None and not args.daemon:
+        parser.error('the following arguments are required: mode')
+    return args
 
-    control(args.serial_port, args.mode, args.brightness, args.speed)
+def main():
+    argv = sys.argv[1:]
+    args = parse_args_fast(argv) or parse_args(argv)
+
+    if args.daemon:
+        try:
+            daemon(args.serial_port, args.inter_byte_delay)
+        except OSError as e:  # Includes serial.SerialException
+            sys.exit(f'Serial port {args.serial_port}: {e}')
+        return
+
+    packet = build_packet(args.mode, args.brightness, args.speed)
+    state = packet + args.serial_port.encode()
+    if not args.force and read_state() == state:
+        print('No change, skipping')
+        return
+    try:
+        sent = control_via_daemon(args.serial_port, packet, args.inter_byte_delay)
+    except OSError as e:
+        sys.exit(f'Daemon {socket_path()}: {e}')
+    if not sent:
+        try:
+            control(args.serial_port, packet, args.inter_byte_delay)
+        except OSError as e:  # Includes serial.SerialException
+            sys.exit(f'Serial port {args.serial_port}: {e}')
+    write_state(state)
+    if args.verbose:
+        print(f'  -> Sent {PACKET_HEX[packet]}')
 
 if __name__ == '__main__':
     main()
-